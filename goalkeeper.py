@@ -1,17 +1,19 @@
+import ctypes
 import enum
+import functools
 import logging
 import math
-import multiprocessing as mp
+import os
 import pickle
 import queue
+import threading
 import time
-from typing import Tuple, List, Optional
+from typing import Tuple, Optional, Callable, Set
 
 import click
 import cv2 as cv
 import numpy as np
 import robomasterpy as rm
-import simple_pid
 from robomasterpy import CTX
 from robomasterpy import framework as rmf
 from robomasterpy import measure
@@ -19,13 +21,146 @@ from robomasterpy import measure
 rm.LOG_LEVEL = logging.DEBUG
 pickle.DEFAULT_PROTOCOL = pickle.HIGHEST_PROTOCOL
 
-GREEN_LOWER = (29, 90, 90)
-GREEN_UPPER = (64, 255, 255)
+GREEN_LOWER = np.array((29, 90, 90), dtype=np.uint8)
+GREEN_UPPER = np.array((64, 255, 255), dtype=np.uint8)
+MORPH_KERNEL = cv.getStructuringElement(cv.MORPH_ELLIPSE, (3, 3))
 BALL_ACTUAL_RADIUS = 0.065 / 2
 
 QUEUE_SIZE: int = 6
 SYSTEM_FREQUENCY: int = 30
 
+PUSH_POSITION: int = 1
+PUSH_ATTITUDE: int = 2
+
+# fixed-layout records carried by RecordRing
+VISION_RECORD = np.dtype([('found', np.uint8), ('forward', np.float64), ('lateral', np.float64), ('horizontal_degree', np.float64), ('timestamp', np.float64)], align=True)
+# position fills x and y, attitude fills z with yaw, just like rm.ChassisPosition
+PUSH_RECORD = np.dtype([('tag', np.uint8), ('x', np.float64), ('y', np.float64), ('z', np.float64)], align=True)
+EVENT_RECORD = np.dtype([('index', np.int32), ('type', np.int32)], align=True)
+
+
+def encode_vision(vision_data: Optional[Tuple[float, float, float, float]]) -> Tuple:
+    if vision_data is None:
+        return 0, 0.0, 0.0, 0.0, 0.0
+    return (1, *vision_data)
+
+
+def _encode_position(push: rm.ChassisPosition) -> Tuple:
+    return PUSH_POSITION, push.x, push.y, 0.0
+
+
+def _encode_attitude(push: rm.ChassisAttitude) -> Tuple:
+    return PUSH_ATTITUDE, 0.0, 0.0, push.yaw
+
+
+PUSH_ENCODERS = {
+    rm.ChassisPosition: _encode_position,
+    rm.ChassisAttitude: _encode_attitude,
+}
+
+
+def encode_push(push) -> Tuple:
+    try:
+        encoder = PUSH_ENCODERS[type(push)]
+    except KeyError:
+        raise ValueError(f'unexpected push content: {push}') from None
+    return encoder(push)
+
+
+def encode_event(hit) -> Tuple:
+    if isinstance(hit, rm.ArmorHitEvent):
+        return hit.index, hit.type
+    raise ValueError(f'unexpected event content: {hit}')
+
+
+class RecordRing:
+    """
+    Single-producer single-consumer ring buffer in shared memory.
+
+    Records have fixed layout(a numpy structured dtype), so nothing is
+    pickled on the way. Head is only written by the consumer and tail
+    only by the producer. Both counters are read and written under their
+    own lock: the lock is what gives the acquire/release fences, so that
+    weakly ordered CPUs like aarch64 never see a tail ahead of its record.
+    A batch of records costs one counter update, not one lock per record.
+
+    It quacks like mp.Queue on the producer side, so that workers of
+    robomasterpy can use it as their out queue. The consumer may wait()
+    for records instead of polling.
+    """
+    POLL_INTERVAL: float = 1 / 1000.0  # in seconds, while waiting for room
+
+    def __init__(self, dtype: np.dtype, capacity: int, encode: Callable[..., Tuple]):
+        assert capacity > 0, 'capacity must be positive'
+        self._dtype = np.dtype(dtype)
+        self._capacity = capacity
+        self._encode = encode
+        self._head = CTX.Value(ctypes.c_uint64, 0)
+        self._tail = CTX.Value(ctypes.c_uint64, 0)
+        self._shm = CTX.RawArray(ctypes.c_uint8, capacity * self._dtype.itemsize)
+        self._filled = CTX.Event()
+        self._attach()
+
+    def _attach(self):
+        self._slots = np.frombuffer(self._shm, dtype=self._dtype, count=self._capacity)
+
+    # shared memory travels to workers when they are spawned, views are rebuilt there.
+    def __getstate__(self):
+        return self._head, self._tail, self._shm, self._filled, self._dtype, self._capacity, self._encode
+
+    def __setstate__(self, state):
+        self._head, self._tail, self._shm, self._filled, self._dtype, self._capacity, self._encode = state
+        self._attach()
+
+    @staticmethod
+    def _load(counter) -> int:
+        with counter.get_lock():
+            return counter.value
+
+    @staticmethod
+    def _store(counter, value: int):
+        with counter.get_lock():
+            counter.value = value
+
+    def put(self, payload, block: bool = True, timeout: Optional[float] = None):
+        tail = self._load(self._tail)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while tail - self._load(self._head) >= self._capacity:
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise queue.Full
+            time.sleep(self.POLL_INTERVAL)
+
+        self._slots[tail % self._capacity] = self._encode(payload)
+        # publish the record only after it is written
+        self._store(self._tail, tail + 1)
+        self._filled.set()
+
+    def put_nowait(self, payload):
+        self.put(payload, block=False)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until a record is put or timeout, call drain() afterwards.
+
+        :return: False on timeout.
+        """
+        filled = self._filled.wait(timeout)
+        # a put racing with clear() is still picked up by the drain() that follows
+        self._filled.clear()
+        return filled
+
+    def drain(self) -> np.ndarray:
+        """
+        Copy out all pending records and release their slots.
+        """
+        head = self._load(self._head)
+        tail = self._load(self._tail)
+        if head == tail:
+            return self._slots[:0]
+        records = self._slots[np.arange(head, tail) % self._capacity]
+        self._store(self._head, tail)
+        return records
+
 
 @enum.unique
 class KeeperState(enum.IntEnum):
@@ -45,6 +180,99 @@ class KeeperState(enum.IntEnum):
         return KeeperState(self._BEGIN + 1)
 
 
+class Display:
+    """
+    Shows images in a HighGUI window from a dedicated thread,
+    so that waitKey() never stalls the caller.
+
+    Only one image waits for display. When the window lags behind,
+    new images are dropped rather than queued, keeping latency low.
+    Callers must not write into an image after handing it over,
+    until it comes back through release: right after imshow() has
+    copied it, or at once when it is dropped.
+
+    The thread always runs under normal scheduling, and on cpus
+    if given, even when its process has gone realtime.
+
+    HighGUI belongs to the display thread alone, the window is torn
+    down there too: call close() instead of cv.destroyAllWindows().
+    """
+    CLOSE_TIMEOUT: float = 1.0  # in seconds
+
+    def __init__(self, window: str, cpus: Optional[Set[int]] = None):
+        self._window = window
+        self._cpus = cpus
+        self._images: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed: bool = False
+
+    # the thread is started in the process actually showing images
+    def __getstate__(self):
+        return self._window, self._cpus
+
+    def __setstate__(self, state):
+        self._window, self._cpus = state
+        self._images = None
+        self._thread = None
+        self._closed = False
+
+    def show(self, image: np.ndarray, release: Optional[Callable[[np.ndarray], None]] = None):
+        if self._closed:
+            if release is not None:
+                release(image)
+            return
+        if self._images is None:
+            self._images = queue.Queue(1)
+            self._thread = threading.Thread(target=self._run, name=f'display-{self._window}', daemon=True)
+            self._thread.start()
+        try:
+            self._images.put_nowait((image, release))
+        except queue.Full:
+            if release is not None:
+                release(image)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is None:
+            return
+
+        # None asks the thread to destroy the window and quit,
+        # it replaces any image still waiting
+        while True:
+            try:
+                self._images.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    image, release = self._images.get_nowait()
+                except queue.Empty:
+                    continue
+                if release is not None:
+                    release(image)
+        self._thread.join(self.CLOSE_TIMEOUT)
+
+    def _run(self):
+        # threads inherit scheduling from their creator
+        if hasattr(os, 'sched_setscheduler'):
+            os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        if self._cpus:
+            os.sched_setaffinity(0, self._cpus)
+
+        while True:
+            item = self._images.get()
+            if item is None:
+                cv.destroyWindow(self._window)
+                cv.waitKey(1)
+                return
+            image, release = item
+            cv.imshow(self._window, image)
+            if release is not None:
+                release(image)
+            cv.waitKey(1)
+
+
 # Build our own worker for complex task
 class KeeperMind(rmf.Worker):
     MAX_EVENT_LAPSE: float = 20 / 1000.0  # in seconds
@@ -56,54 +284,102 @@ class KeeperMind(rmf.Worker):
     DISTANCE_EPS: float = 0.01  # in meters
     SLEEP_SECONDS: float = 1.0
     GRAPH_SIZE: int = 600
+    GRAPH_INTERVAL: float = 0.1  # in seconds, the graph is for human eyes
+    TICK_INTERVAL: float = 1 / SYSTEM_FREQUENCY  # in seconds, longest wait for a vision record
+    # lateral PID, error is lateral distance of ball, setpoint is 0
+    Y_PID_KP: float = 10.0
+    Y_PID_KI: float = 0.1
+    Y_PID_KD: float = 0.5
+    Y_DEAD_BAND: float = 0.1  # in m/s, slower output is treated as 0
 
     def __init__(self, name: str, ip: str,
-                 vision: mp.Queue, push: mp.Queue, event: mp.Queue,
+                 vision: RecordRing, push: RecordRing, event: RecordRing,
                  field_width: float, field_depth: float, timeout: float = 10,
-                 xy_speed: float = 0.4, z_speed: float = 60):
+                 xy_speed: float = 0.4, z_speed: float = 60,
+                 cpu: Optional[int] = None, priority: int = 0):
         super().__init__(name, None, None, (ip, 0), timeout, True)
         self._z_speed = z_speed
         self._xy_speed = xy_speed
         self._state: KeeperState = KeeperState.WATCHING
+        # indexed by KeeperState
+        self._state_handlers: Tuple[Callable[[], None], ...] = (self._unknown_state, self._watch, self._chase, self._kick, self._unknown_state)
         self._max_y = field_width / 2.0
         self._max_x = field_depth / 2.0
         self._vision = vision
-        self._push = push
-        self._event = event
-        self._y_pid: simple_pid.PID = simple_pid.PID(-10, -0.1, -0.5, setpoint=0, sample_time=1.0 / SYSTEM_FREQUENCY, output_limits=(-self._xy_speed, self._xy_speed))
+        self._drains = (
+            (vision, self._on_vision),
+            (push, self._on_push),
+            (event, self._on_event),
+        )
+        self._reset_y_pid()
 
         if field_width > field_depth:
             self._graph_pixel_size: float = 0.8 * self.GRAPH_SIZE / field_width  # pixel per meter
         else:
             self._graph_pixel_size: float = 0.8 * self.GRAPH_SIZE / field_depth  # pixel per meter
-        self._graph_chassis_width = self._graph_pixel_size * measure.INFANTRY_WIDTH
-        self._graph_chassis_length = self._graph_pixel_size * measure.INFANTRY_LENGTH
+        self._graph_chassis_half_width = int(self._graph_pixel_size * measure.INFANTRY_WIDTH / 2)
+        self._graph_chassis_half_length = int(self._graph_pixel_size * measure.INFANTRY_LENGTH / 2)
         self._graph_ball_radius = int(BALL_ACTUAL_RADIUS * self._graph_pixel_size)
+        self._graph_center: int = int(0.5 * self.GRAPH_SIZE)
         self._graph_base = np.zeros((self.GRAPH_SIZE, self.GRAPH_SIZE, 3), dtype=np.uint8)
         cv.rectangle(self._graph_base, self._graph_offset(-0.5 * field_width * self._graph_pixel_size, -0.5 * field_depth * self._graph_pixel_size), self._graph_offset(0.5 * field_width * self._graph_pixel_size, 0.5 * field_depth * self._graph_pixel_size), (255, 0, 0), 4)
+        # free list: one in imshow(), one waiting for display, one being drawn
+        self._free_graphs = queue.Queue()
+        for _ in range(3):
+            self._free_graphs.put_nowait(np.empty_like(self._graph_base))
+        self._graph_last_drawn: float = 0
+        # keep the graph off the control cpu
+        self._graph_display = Display('graph', os.sched_getaffinity(0) - {cpu} if cpu is not None else None)
 
         # dynamic states
-        self._position: rm.ChassisPosition = rm.ChassisPosition(0, 0, 0)
+        # chassis position as plain floats, z is yaw in degrees
+        self._pos_x: float = 0.0
+        self._pos_y: float = 0.0
+        self._pos_z: float = 0.0
         self._position_last_seen: Optional[float] = None
+        self._push_handlers = {
+            PUSH_POSITION: self._apply_position,
+            PUSH_ATTITUDE: self._apply_attitude,
+        }
         self._ball_distances: Optional[Tuple[float, float, float]] = None
         self._vision_last_updated: Optional[float] = None
         self._ball_last_seen: Optional[float] = None
+        self._ball_sampled_at: Optional[float] = None  # timestamp from vision worker
         self._armor_hit_id: Optional[int] = None
         self._armor_hit_last_seen: Optional[float] = None
 
         self._last_recenter_time: float = 0
+        # sampled once per tick, every timestamp of KeeperMind comes from here
+        self._now: float = time.monotonic()
 
         self._cmd = rm.Commander(ip, timeout)
         self._cmd.robot_mode(rm.MODE_CHASSIS_LEAD)
         self._cmd.gimbal_moveto(pitch=-10)
 
         self._init_state()
+        self._go_realtime(cpu, priority)
+
+    def _go_realtime(self, cpu: Optional[int], priority: int):
+        """
+        Pin the control loop to a cpu(ideally isolated by isolcpus kernel arg)
+        and/or put it under SCHED_FIFO, cutting the jitter of ticks
+        caused by preemption from other processes.
+        """
+        if cpu is not None:
+            os.sched_setaffinity(0, {cpu})
+            self.logger.info('controller pinned to cpu %d', cpu)
+        if priority > 0:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+                self.logger.info('controller running under SCHED_FIFO, priority %d', priority)
+            except PermissionError:
+                self.logger.warning('no permission for SCHED_FIFO(needs root or CAP_SYS_NICE), keep normal scheduling')
 
     def _graph_offset(self, x: float, y: float) -> Tuple[int, int]:
-        center = 0.5 * self.GRAPH_SIZE
-        return int(center + x), int(center + y)
+        return int(self._graph_center + x), int(self._graph_center + y)
 
     def close(self):
+        self._graph_display.close()
         self._cmd.close()
         super().close()
 
@@ -122,7 +398,7 @@ class KeeperMind(rmf.Worker):
             self._recenter_to_field()
             self._cmd.led_control(rm.LED_ALL, rm.LED_EFFECT_PULSE, 0, 255, 0)
         elif self._state == KeeperState.CHASING:
-            self._y_pid.reset()
+            self._reset_y_pid()
             self._cmd.led_control(rm.LED_ALL, rm.LED_EFFECT_SOLID, 0, 0, 255)
         elif self._state == KeeperState.KICKING:
             self._cmd.chassis_move(-self._max_x * 2 / 3, speed_xy=self._xy_speed)
@@ -130,65 +406,102 @@ class KeeperMind(rmf.Worker):
         else:
             raise ValueError(f'unknown state {self._state}')
 
-    def _dequeue_vision(self):
-        vision_data = None
-        now = time.time()
-        while not self.closed:
-            try:
-                vision_data = self._vision.get_nowait()
-            except queue.Empty:
-                return
-
-            self._vision_last_updated = now
-            if vision_data is not None:
-                self._ball_distances = vision_data
-                self._ball_last_seen = now
-
-    def _dequeue_push(self):
-        push = None
-        while not self.closed:
+    def _drain_all(self):
+        """
+        One pass over every ring, each drained with a single copy.
+        Rings stay separate as each of them has exactly one producer.
+        """
+        for ring, handler in self._drains:
+            records = ring.drain()
+            if len(records) > 0:
+                handler(records)
+
+    def _on_vision(self, records: np.ndarray):
+        self._vision_last_updated = self._now
+        found = records[records['found'] != 0]
+        if len(found) > 0:
+            latest = found[-1]
+            self._ball_distances = float(latest['forward']), float(latest['lateral']), float(latest['horizontal_degree'])
+            self._ball_sampled_at = float(latest['timestamp'])
+            self._ball_last_seen = self._now
+
+    def _on_push(self, records: np.ndarray):
+        self._position_last_seen = self._now
+        # one C pass turns the binary records into plain python tuples
+        for tag, x, y, z in records.tolist():
             try:
-                push = self._push.get_nowait()
-            except queue.Empty:
-                return
-
-            self._position_last_seen = time.time()
-            if type(push) == rm.ChassisPosition:
-                self._position.x, self._position.y = push.x, push.y
-            elif type(push) == rm.ChassisAttitude:
-                self._position.z = push.yaw
-            else:
-                raise ValueError(f'unexpected push content: {push}')
-
-    def _dequeue_event(self):
-        hit = None
-        while not self.closed:
-            try:
-                hit = self._event.get_nowait()
-            except queue.Empty:
-                return
-            self._armor_hit_last_seen = time.time()
-            if type(hit) == rm.ArmorHitEvent:
-                self._armor_hit_id = hit.index
-            else:
-                raise ValueError(f'unexpected event content: {hit}')
+                handler = self._push_handlers[tag]
+            except KeyError:
+                raise ValueError(f'unexpected push tag: {tag}') from None
+            handler(x, y, z)
+
+    def _apply_position(self, x: float, y: float, _z: float):
+        self._pos_x, self._pos_y = x, y
+
+    def _apply_attitude(self, _x: float, _y: float, z: float):
+        self._pos_z = z
+
+    def _on_event(self, records: np.ndarray):
+        self._armor_hit_last_seen = self._now
+        self._armor_hit_id = int(records[-1]['index'])
+
+    def _reset_y_pid(self):
+        self._y_pid_integral: float = 0.0
+        self._y_pid_last_error: Optional[float] = None
+        self._y_pid_last_time: Optional[float] = None
+        self._y_pid_output: float = 0.0
+
+    def _y_pid(self, lateral: float) -> float:
+        """
+        PID on lateral distance of the ball, stepped with the measured dt
+        between vision samples rather than an assumed frequency,
+        so that jitter of ticks does not skew Ki and Kd.
+
+        Output is clamped to xy speed and dead-banded in one go.
+        Integral only accumulates while output is not saturated(anti-windup).
+        """
+        sampled_at = self._ball_sampled_at
+        last_time = self._y_pid_last_time
+        if last_time is not None and sampled_at <= last_time:
+            # no new sample since last step
+            return self._y_pid_output
+
+        error = lateral
+        integral = self._y_pid_integral
+        derivative = 0.0
+        if last_time is not None:
+            dt = sampled_at - last_time
+            integral += error * dt
+            derivative = (error - self._y_pid_last_error) / dt
+
+        output = self.Y_PID_KP * error + self.Y_PID_KI * integral + self.Y_PID_KD * derivative
+        max_output = self._xy_speed
+        clamped = min(max_output, max(-max_output, output))
+        if clamped == output:
+            self._y_pid_integral = integral
+        self._y_pid_output = clamped if clamped * clamped >= self.Y_DEAD_BAND * self.Y_DEAD_BAND else 0.0
+        self._y_pid_last_error = error
+        self._y_pid_last_time = sampled_at
+        return self._y_pid_output
 
     def _recenter_to_field(self):
-        self._last_recenter_time = time.time()
-        diff_x = 0 if math.fabs(self._position.x) < self.DISTANCE_EPS else self._position.x
-        diff_y = 0 if math.fabs(self._position.y) < self.DISTANCE_EPS else self._position.y
-        diff_z = 0 if math.fabs(self._position.z) < self.DEGREE_EPS else self._position.z
+        self._last_recenter_time = self._now
+        pos_x, pos_y, pos_z = self._pos_x, self._pos_y, self._pos_z
+        diff_x = 0 if abs(pos_x) < self.DISTANCE_EPS else pos_x
+        diff_y = 0 if abs(pos_y) < self.DISTANCE_EPS else pos_y
+        diff_z = 0 if abs(pos_z) < self.DEGREE_EPS else pos_z
         if any((diff_x, diff_y, diff_z)):
-            self._cmd.chassis_move(-self._position.x, -self._position.y, -diff_z, speed_xy=self._xy_speed, speed_z=self._z_speed)
+            self._cmd.chassis_move(-pos_x, -pos_y, -diff_z, speed_xy=self._xy_speed, speed_z=self._z_speed)
 
     def _watch(self):
-        now = time.time()
+        now = self._now
         if now - self._last_recenter_time > 3:
             self._recenter_to_field()
 
-        if self._ball_distances is None or now - self._ball_last_seen > 3:
+        ball_distances = self._ball_distances
+        if ball_distances is None or now - self._ball_last_seen > 3:
             return
-        forward = self._ball_distances[0]
+        forward = ball_distances[0]
         if forward < self.CHASE_ENTER_FORWARD_THRESHOLD:
             self._next_state()
 
@@ -203,11 +516,13 @@ class KeeperMind(rmf.Worker):
                     return False
 
             time.sleep(self.SLEEP_SECONDS)
+            # the tick's timestamp is stale after sleeping
+            self._now = time.monotonic()
             self._reset_state()
             return False
 
         # timeout
-        now = time.time()
+        now = self._now
         if now - self._ball_last_seen > self.BALL_ABSENT_TIMEOUT:
             self._reset_state()
             return False
@@ -223,19 +538,18 @@ class KeeperMind(rmf.Worker):
             self._reset_state()
             return False
 
-        if math.fabs(self._position.x) > self._max_x:
+        pos_x, pos_y, max_y = self._pos_x, self._pos_y, self._max_y
+        if abs(pos_x) > self._max_x:
             self._reset_state()
             self._cmd.led_control(rm.LED_BOTTOM_FRONT, rm.LED_EFFECT_BLINK, 0, 0, 255)
             self._cmd.led_control(rm.LED_BOTTOM_BACK, rm.LED_EFFECT_BLINK, 0, 0, 255)
             return False
 
-        if self._position.y > self._max_y:
+        # -1 beyond left bound, 1 beyond right bound, 0 inside
+        side = (pos_y > max_y) - (pos_y < -max_y)
+        if side != 0:
             self._reset_state()
-            self._cmd.led_control(rm.LED_BOTTOM_RIGHT, rm.LED_EFFECT_BLINK, 0, 0, 255)
-            return False
-        if self._position.y < -self._max_y:
-            self._reset_state()
-            self._cmd.led_control(rm.LED_BOTTOM_LEFT, rm.LED_EFFECT_BLINK, 0, 0, 255)
+            self._cmd.led_control(rm.LED_BOTTOM_RIGHT if side > 0 else rm.LED_BOTTOM_LEFT, rm.LED_EFFECT_BLINK, 0, 0, 255)
             return False
 
         return True
@@ -251,7 +565,6 @@ class KeeperMind(rmf.Worker):
             self._next_state()
             return
         vy = self._y_pid(lateral)
-        vy = 0 if math.fabs(vy) < 0.1 else vy
         if vy != 0:
             self._cmd.chassis_speed(y=vy)
         else:
@@ -264,113 +577,300 @@ class KeeperMind(rmf.Worker):
 
         forward, lateral, horizontal_degree = self._ball_distances
         vy = self._y_pid(lateral)
-        vy = 0 if math.fabs(vy) < 0.1 else vy
         if vy != 0:
             self._cmd.chassis_speed(x=self._xy_speed, y=vy)
         else:
             self._cmd.chassis_speed(x=self._xy_speed)
 
     def _draw_graph(self):
-        if self._ball_distances is None:
+        now = self._now
+        if self._ball_distances is None or now - self._graph_last_drawn < self.GRAPH_INTERVAL:
             return
+        self._graph_last_drawn = now
 
-        graph = self._graph_base.copy()
-
-        chassis_x = self._position.y
-        chassis_y = self._position.x
-        chassis_x_pixel, chassis_y_pixel = self._graph_offset(chassis_x * self._graph_pixel_size, chassis_y * self._graph_pixel_size)
-        cv.rectangle(graph, (int(chassis_x_pixel - self._graph_chassis_width / 2), int(chassis_y_pixel - self._graph_chassis_length / 2)), (int(chassis_x_pixel + self._graph_chassis_width / 2), int(chassis_y_pixel + self._graph_chassis_length / 2)), (0, 0, 255), 2)
+        try:
+            graph = self._free_graphs.get_nowait()
+        except queue.Empty:
+            return
+        np.copyto(graph, self._graph_base)
 
+        pos_x, pos_y = self._pos_x, self._pos_y
         forward, lateral, _ = self._ball_distances
-        ball_x_pixel, ball_y_pixel = self._graph_offset((lateral + self._position.y) * self._graph_pixel_size, (forward + self._position.x) * self._graph_pixel_size)
+        # chassis and ball in pixel, graph x is robot y
+        chassis_x_pixel, chassis_y_pixel, ball_x_pixel, ball_y_pixel = (np.array((pos_y, pos_x, lateral + pos_y, forward + pos_x)) * self._graph_pixel_size + self._graph_center).astype(np.int32).tolist()
+        cv.rectangle(graph, (chassis_x_pixel - self._graph_chassis_half_width, chassis_y_pixel - self._graph_chassis_half_length), (chassis_x_pixel + self._graph_chassis_half_width, chassis_y_pixel + self._graph_chassis_half_length), (0, 0, 255), 2)
 
         cv.circle(graph, (ball_x_pixel, ball_y_pixel), self._graph_ball_radius, (0, 255, 0), 2)
         cv.circle(graph, (ball_x_pixel, ball_y_pixel), 1, (0, 128, 128), 2)
         cv.putText(graph, str(self._state), (20, 20), cv.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
 
-        now = time.time()
         cv.putText(graph, 'vision heath: %.2f ms' % ((now - self._vision_last_updated) * 1000 if self._vision_last_updated is not None else -1.0), (20, 70), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
         cv.putText(graph, 'position heath: %.2f ms' % ((now - self._position_last_seen) * 1000 if self._position_last_seen is not None else -1.0), (20, 120), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
         cv.putText(graph, 'hit last seen: %.2f ms' % ((now - self._armor_hit_last_seen) * 1000 if self._armor_hit_last_seen is not None else -1.0), (20, 170), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-        cv.putText(graph, 'robot position: %.2f, %.2f, %2f' % (self._position.x, self._position.y, self._position.z), (20, 220), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-        cv.putText(graph, 'ball last seen: %.2f ms' % ((now - self._ball_last_seen) * 1000 if self._vision_last_updated is not None else -1.0), (20, 270), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        cv.putText(graph, 'robot position: %.2f, %.2f, %2f' % (pos_x, pos_y, self._pos_z), (20, 220), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        cv.putText(graph, 'ball last seen: %.2f ms' % ((now - self._ball_last_seen) * 1000 if self._ball_last_seen is not None else -1.0), (20, 270), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
 
-        cv.imshow('graph', graph)
-        cv.waitKey(1)
+        self._graph_display.show(graph, self._free_graphs.put_nowait)
 
     def _tick(self):
         self._armor_hit_id = None
 
-        self._dequeue_vision()
-        self._dequeue_push()
-        self._dequeue_event()
+        self._drain_all()
 
         self._draw_graph()
 
     def work(self) -> None:
+        # tick as soon as a ball sample lands, and keep ticking without one
+        # for timeouts. Never spinning lets a SCHED_FIFO loop leave its cpu alone.
+        self._vision.wait(self.TICK_INTERVAL)
+        self._now = time.monotonic()
         self._tick()
+        self._state_handlers[self._state]()
+
+    def _unknown_state(self):
+        raise ValueError(f'unknown state {self._state}')
+
+
+class KeeperVision(rmf.Vision):
+    """
+    Vision worker decoding frames into a small pool of reused buffers,
+    instead of allocating a new frame for every read.
+
+    A grabber thread keeps pulling the stream, so that processing always
+    starts from the newest frame instead of a stale one queued in buffers.
+    Frames arriving while processing is busy are dropped.
+
+    Frames never leave this process: processing runs right here and only
+    its small result goes through RecordRing. Processing owns the frame it
+    is given and must hand it back through release once nothing reads it.
+
+    Pass the display processing draws to, so that close() can take its
+    window down on the display thread.
+    """
+    FRAME_BUFFERS: int = 3  # one in imshow(), one waiting for display, one being processed
+
+    def __init__(self, name: str, out: Optional[RecordRing], ip: str, processing: Callable[..., None], none_is_valid=False,
+                 display: Optional[Display] = None):
+        super().__init__(name, out, ip, processing, none_is_valid)
+        self._display = display
+        # waking a thread pool per call costs more than it gains on jobs this small
+        cv.setUseOptimized(True)
+        cv.setNumThreads(1)
+        self._cap.set(cv.CAP_PROP_BUFFERSIZE, 1)
+        # free list of frame buffers, None until allocated by the first retrieve
+        self._free_frames = queue.Queue()
+        for _ in range(self.FRAME_BUFFERS):
+            self._free_frames.put_nowait(None)
+
+        # hand-over between grabber and work(), only one of them touches the capture at a time
+        self._frame_wanted: bool = False
+        self._grab_ok: bool = False
+        self._grabbed = threading.Event()
+        self._retrieved = threading.Event()
+        self._stopping = threading.Event()
+        self._grabber = threading.Thread(target=self._grab, name=f'{name}-grabber', daemon=True)
+        self._grabber.start()
 
-        if self._state == KeeperState.WATCHING:
-            self._watch()
-        elif self._state == KeeperState.CHASING:
-            self._chase()
-        elif self._state == KeeperState.KICKING:
-            self._kick()
+    def close(self):
+        if self.closed:
+            return
+        self._stopping.set()
+        self._retrieved.set()
+        if self._display is not None:
+            self._display.close()
+        self._grabber.join(self.TIMEOUT)
+        if self._grabber.is_alive():
+            # releasing the capture under a blocked grab() frees it while in use,
+            # leave it to process exit instead
+            self.logger.warning('grabber still blocked in grab(), capture left open')
         else:
-            raise ValueError(f'unknown state {self._state}')
-
-
-def contour_analysis(cnt) -> Tuple[int, int]:
-    approx = cv.approxPolyDP(cnt, 0.01 * cv.arcLength(cnt, True), True)
-    area = cv.contourArea(cnt)
-    return len(approx), area
-
-
-def biggest_circle_cnt(cnts: List):
-    found_cnt = None
-    found_edges = 0
-    found_area = 0
-
-    for cnt in cnts:
-        edges, area = contour_analysis(cnt)
-        if edges > 8 \
-                and 260 < area < 20000 \
-                and edges > found_edges \
-                and area > found_area:
-            found_edges = edges
-            found_area = area
-            found_cnt = cnt
-
-    return found_cnt
+            self._cap.release()
+        # not rmf.Vision.close(), its destroyAllWindows() would call HighGUI off the display thread
+        rmf.Worker.close(self)
+
+    def _grab(self):
+        while not self._stopping.is_set():
+            ok = self._cap.grab()
+            if self._frame_wanted or not ok:
+                self._frame_wanted = False
+                self._grab_ok = ok
+                self._grabbed.set()
+                # capture is work()'s until it retrieves
+                self._retrieved.wait()
+                self._retrieved.clear()
+            if not ok:
+                return
 
+    def work(self) -> None:
+        self._frame_wanted = True
+        if not self._grabbed.wait(self.TIMEOUT):
+            if self.closed:
+                return
+            raise ValueError('can not receive frame (stream stalled?)')
+        self._grabbed.clear()
 
-def vision(frame, logger: logging.Logger) -> Optional[Tuple[float, float, float]]:
-    processed = cv.GaussianBlur(frame, (11, 11), 0)
-    processed = cv.cvtColor(processed, cv.COLOR_BGR2HSV)
+        ok, frame = False, None
+        if self._grab_ok:
+            try:
+                buffer = self._free_frames.get(timeout=self.TIMEOUT)
+            except queue.Empty:
+                self._retrieved.set()
+                raise ValueError('no frame buffer released (processing leaks frames?)') from None
+            ok, frame = self._cap.retrieve(buffer)
+            if not ok:
+                self._free_frames.put_nowait(buffer)
+        self._retrieved.set()
+        if not ok:
+            if self.closed:
+                return
+            else:
+                raise ValueError('can not receive frame (stream end?)')
+
+        processed = self._processing(frame=frame, logger=self.logger, release=self._free_frames.put_nowait)
+        if processed is not None or self._none_is_valid:
+            self._outlet(processed)
+
+
+class BallTracker:
+    """
+    Keeps the ball found in last frame, so that the next frame
+    only needs a search in its neighbourhood.
+    Search over the whole frame is the cold start
+    and fallback on miss or every FULL_SEARCH_INTERVAL frames.
+
+    Both searches measure the ball the same way: centroid and
+    area equivalent radius of the largest blob in range,
+    so switching between them does not move the estimate.
+    tools/find-ball.py measures with it too.
+    """
+    ROI_SCALE: float = 3.0  # ROI half size, in ball radius
+    FULL_SEARCH_INTERVAL: int = 30  # in frames
+    MIN_BALL_AREA: int = 260  # in pixels
+    MAX_BALL_AREA: int = 20000  # in pixels
+    # area equivalent radius reads this much below the enclosing circle of
+    # the blurred mask that measure.FOCAL_LENGTH_HD was calibrated against
+    RADIUS_BIAS: float = 1.25  # in pixels
+
+    def __init__(self):
+        self._last_ball: Optional[Tuple[float, float, float]] = None
+        self._tracked_frames: int = 0
+        # outputs of last search, written in place when shapes still match
+        self._labels: Optional[np.ndarray] = None
+        self._stats: Optional[np.ndarray] = None
+        self._centroids: Optional[np.ndarray] = None
+
+    def locate(self, mask: np.ndarray) -> Optional[Tuple[float, float, float]]:
+        """
+        :return: x, y and radius of the ball in pixel, None if absent.
+        """
+        ball = None
+        if self._last_ball is not None and self._tracked_frames < self.FULL_SEARCH_INTERVAL:
+            ball = self._track(mask, *self._last_ball)
+            self._tracked_frames += 1
+        if ball is None:
+            ball = self._search(mask)
+            self._tracked_frames = 0
+
+        self._last_ball = ball
+        return ball
+
+    def _track(self, mask: np.ndarray, x: float, y: float, radius: float) -> Optional[Tuple[float, float, float]]:
+        height, width = mask.shape[:2]
+        span = self.ROI_SCALE * radius
+        left, top = max(int(x - span), 0), max(int(y - span), 0)
+        right, bottom = min(int(x + span) + 1, width), min(int(y + span) + 1, height)
+        if right - left < radius or bottom - top < radius:
+            return None
+
+        # the ROI changes size every frame, its outputs are not worth keeping
+        _, _, stats, centroids = cv.connectedComponentsWithStats(mask[top:bottom, left:right], connectivity=8)
+        ball = self._largest_ball(stats, centroids)
+        if ball is None:
+            return None
+
+        roi_x, roi_y, pixel_radius = ball
+        return left + roi_x, top + roi_y, pixel_radius
+
+    def _search(self, mask: np.ndarray) -> Optional[Tuple[float, float, float]]:
+        # area, bounding box and centroid of every blob in a single pass
+        _, self._labels, self._stats, self._centroids = cv.connectedComponentsWithStats(mask, labels=self._labels, stats=self._stats, centroids=self._centroids, connectivity=8)
+        return self._largest_ball(self._stats, self._centroids)
+
+    def _largest_ball(self, stats: np.ndarray, centroids: np.ndarray) -> Optional[Tuple[float, float, float]]:
+        areas = stats[1:, cv.CC_STAT_AREA]  # label 0 is background
+        candidates = np.flatnonzero((areas > self.MIN_BALL_AREA) & (areas < self.MAX_BALL_AREA))
+        if len(candidates) == 0:
+            return None
+
+        best = candidates[areas[candidates].argmax()]
+        x, y = centroids[best + 1]
+        return float(x), float(y), math.sqrt(areas[best] / math.pi) + self.RADIUS_BIAS
+
+
+def green_mask(frame: np.ndarray) -> np.ndarray:
+    # no blur here, opening the mask already removes the noise.
+    # UMat lets OpenCV dispatch to OpenCL when available.
+    processed = cv.cvtColor(cv.UMat(frame), cv.COLOR_BGR2HSV)
 
     mask = cv.inRange(processed, GREEN_LOWER, GREEN_UPPER)
-    mask = cv.morphologyEx(mask, cv.MORPH_OPEN, None)
-    cnts, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
-
-    ball_cnt = biggest_circle_cnt(cnts)
-    if ball_cnt is None:
+    mask = cv.morphologyEx(mask, cv.MORPH_OPEN, MORPH_KERNEL)
+    return mask.get()
+
+
+class CudaGreenMask:
+    """
+    green_mask() on a CUDA device, for Jetson class boards.
+    Only the final single channel mask is downloaded.
+
+    Device buffer and filter are built on first call,
+    in the process using them.
+    """
+
+    def __init__(self):
+        self._frame = None
+        self._open = None
+
+    @staticmethod
+    def available() -> bool:
+        return hasattr(cv, 'cuda') \
+               and hasattr(cv.cuda, 'inRange') \
+               and hasattr(cv.cuda, 'createMorphologyFilter') \
+               and cv.cuda.getCudaEnabledDeviceCount() > 0
+
+    def __call__(self, frame: np.ndarray) -> np.ndarray:
+        if self._open is None:
+            self._frame = cv.cuda_GpuMat()
+            self._open = cv.cuda.createMorphologyFilter(cv.MORPH_OPEN, cv.CV_8UC1, MORPH_KERNEL)
+
+        self._frame.upload(frame)
+        processed = cv.cuda.cvtColor(self._frame, cv.COLOR_BGR2HSV)
+        mask = cv.cuda.inRange(processed, tuple(GREEN_LOWER.tolist()), tuple(GREEN_UPPER.tolist()))
+        mask = self._open.apply(mask)
+        return mask.download()
+
+
+def vision(frame, logger: logging.Logger, tracker: BallTracker, display: Display,
+           mask_of: Callable[[np.ndarray], np.ndarray] = green_mask,
+           focal_length: float = measure.FOCAL_LENGTH_HD,
+           release: Optional[Callable[[np.ndarray], None]] = None) -> Optional[Tuple[float, float, float, float]]:
+    captured_at = time.monotonic()
+    ball = tracker.locate(mask_of(frame))
+    if ball is None:
         cv.putText(frame, 'no ball detected', (50, 20), cv.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-        cv.imshow('vision', frame)
-        cv.waitKey(1)
+        display.show(frame, release)
         return None
 
-    (x, y), pixel_radius = cv.minEnclosingCircle(ball_cnt)
-    distance = measure.pinhole_distance(BALL_ACTUAL_RADIUS, pixel_radius)
+    x, y, pixel_radius = ball
+    distance = measure.pinhole_distance(BALL_ACTUAL_RADIUS, pixel_radius, focal_length)
     forward, lateral, horizontal_degree = measure.distance_decomposition(x, distance)
     cv.circle(frame, (int(x), int(y)), int(pixel_radius), (0, 255, 0), 2)
     cv.circle(frame, (int(x), int(y)), 1, (0, 0, 255), 2)
     cv.putText(frame, 'forward: %.1f cm' % (forward * 100), (50, 20), cv.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
     cv.putText(frame, 'lateral: %.1f cm' % (lateral * 100), (50, 70), cv.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
 
-    cv.imshow('vision', frame)
-    cv.waitKey(1)
+    display.show(frame, release)
 
-    return forward, lateral, horizontal_degree
+    return forward, lateral, horizontal_degree, captured_at
 
 
 @click.command()
@@ -380,41 +880,51 @@ def vision(frame, logger: logging.Logger) -> Optional[Tuple[float, float, float]
 @click.option('--max-depth', default=0.5, type=float, help='(Optional) Field depth')
 @click.option('--xy-speed', default=0.4, type=float, help='(Optional) Speed in x and y direction')
 @click.option('--z-speed', default=60, type=float, help='(Optional) Speed in z direction(chassis roll)')
-def cli(ip: str, timeout: float, max_width: float, max_depth: float, xy_speed: float, z_speed: float):
-    manager: mp.managers.SyncManager = CTX.Manager()
-
-    with manager:
-        hub = rmf.Hub()
-        cmd = rm.Commander(ip=ip, timeout=timeout)
-        ip = cmd.get_ip()
-
-        # queues
-        vision_queue = manager.Queue(QUEUE_SIZE)
-        push_queue = manager.Queue(QUEUE_SIZE)
-        event_queue = manager.Queue(QUEUE_SIZE)
-
-        # vision
-        cmd.stream(True)
-        hub.worker(rmf.Vision, 'vision', (vision_queue, ip, vision), {'none_is_valid': True})
-
-        # push and event
-        cmd.chassis_push_on(position_freq=SYSTEM_FREQUENCY, attitude_freq=SYSTEM_FREQUENCY)
-        cmd.armor_sensitivity(10)
-        cmd.armor_event(rm.ARMOR_HIT, True)
-        hub.worker(rmf.PushListener, 'chassis-push', (push_queue,))
-        hub.worker(rmf.EventListener, 'armor-event', (event_queue, ip))
-
-        # controller
-        hub.worker(KeeperMind, 'controller',
-                   (ip, vision_queue, push_queue, event_queue, max_width, max_depth),
-                   {
-                       'timeout': timeout,
-                       'xy_speed': xy_speed,
-                       'z_speed': z_speed,
-                   },
-                   )
-
-        hub.run()
+@click.option('--focal-length', default=measure.FOCAL_LENGTH_HD, type=float, help='(Optional) Focal length under 720p, calibrate with tools/find-ball.py')
+@click.option('--cpu', default=None, type=int, help='(Optional, Linux) Pin the controller to this CPU')
+@click.option('--priority', default=0, type=click.IntRange(0, 99), help='(Optional, Linux) Run the controller under SCHED_FIFO with this priority, 0 to disable, requires --cpu')
+def cli(ip: str, timeout: float, max_width: float, max_depth: float, xy_speed: float, z_speed: float, focal_length: float, cpu: Optional[int], priority: int):
+    if priority > 0 and cpu is None:
+        # a SCHED_FIFO loop free to roam may starve vision and push workers
+        raise click.UsageError('--priority requires --cpu')
+
+    hub = rmf.Hub()
+    cmd = rm.Commander(ip=ip, timeout=timeout)
+    ip = cmd.get_ip()
+
+    # shared memory rings, one producer and one consumer each
+    vision_ring = RecordRing(VISION_RECORD, QUEUE_SIZE, encode_vision)
+    push_ring = RecordRing(PUSH_RECORD, QUEUE_SIZE, encode_push)
+    event_ring = RecordRing(EVENT_RECORD, QUEUE_SIZE, encode_event)
+
+    # vision
+    cmd.stream(True)
+    mask_of = CudaGreenMask() if CudaGreenMask.available() else green_mask
+    vision_display = Display('vision')
+    hub.worker(KeeperVision, 'vision',
+               (vision_ring, ip, functools.partial(vision, tracker=BallTracker(), display=vision_display, mask_of=mask_of, focal_length=focal_length)),
+               {'none_is_valid': True, 'display': vision_display})
+
+    # push and event
+    cmd.chassis_push_on(position_freq=SYSTEM_FREQUENCY, attitude_freq=SYSTEM_FREQUENCY)
+    cmd.armor_sensitivity(10)
+    cmd.armor_event(rm.ARMOR_HIT, True)
+    hub.worker(rmf.PushListener, 'chassis-push', (push_ring,))
+    hub.worker(rmf.EventListener, 'armor-event', (event_ring, ip))
+
+    # controller
+    hub.worker(KeeperMind, 'controller',
+               (ip, vision_ring, push_ring, event_ring, max_width, max_depth),
+               {
+                   'timeout': timeout,
+                   'xy_speed': xy_speed,
+                   'z_speed': z_speed,
+                   'cpu': cpu,
+                   'priority': priority,
+               },
+               )
+
+    hub.run()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,17 @@
 import math
-from typing import Tuple, List
+import os
+import sys
+from typing import Tuple
 
 import click
 import cv2 as cv
 import numpy as np
 
-GREEN_LOWER = (29, 90, 90)
-GREEN_UPPER = (64, 255, 255)
-BALL_ACTUAL_RADIUS = 0.065 / 2
+# measure the ball exactly as goalkeeper.py one level up does,
+# so that focal lengths found here hold there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from goalkeeper import BALL_ACTUAL_RADIUS, BallTracker, green_mask
+
 FOCAL_LENGTH_HD = 710
 HORIZONTAL_DEGREES = 96
 VERTICAL_DEGREES = 54
@@ -21,43 +25,14 @@ def distance_decomposition(pixel_x: float, distance: float) -> Tuple[float, floa
     return forward_distance, lateral_distance
 
 
-def contour_analysis(cnt) -> Tuple[int, int]:
-    approx = cv.approxPolyDP(cnt, 0.01 * cv.arcLength(cnt, True), True)
-    area = cv.contourArea(cnt)
-    return len(approx), area
-
-
-def biggest_circle_cnt(cnts: List):
-    found_cnt = None
-    found_edges = 0
-    found_area = 0
-
-    for cnt in cnts:
-        edges, area = contour_analysis(cnt)
-        if edges > 8 \
-                and 260 < area < 20000 \
-                and edges > found_edges \
-                and area > found_area:
-            found_edges = edges
-            found_area = area
-            found_cnt = cnt
-
-    return found_cnt
-
-
 def process(frame: np.ndarray):
-    processed = cv.GaussianBlur(frame, (11, 11), 0)
-    processed = cv.cvtColor(processed, cv.COLOR_BGR2HSV)
-
-    mask = cv.inRange(processed, GREEN_LOWER, GREEN_UPPER)
-    mask = cv.morphologyEx(mask, cv.MORPH_OPEN, None)
+    mask = green_mask(frame)
     cv.imshow('mask', mask)
-    cnts, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
 
-    ball_cnt = biggest_circle_cnt(cnts)
-    assert ball_cnt is not None, 'failed to find ball'
+    ball = BallTracker().locate(mask)
+    assert ball is not None, 'failed to find ball'
 
-    (x, y), radius = cv.minEnclosingCircle(ball_cnt)
+    x, y, radius = ball
     cv.circle(frame, (int(x), int(y)), int(radius), (0, 255, 0), 2)
     cv.circle(frame, (int(x), int(y)), 1, (0, 0, 255), 2)
 